@@ -0,0 +1,409 @@
+"""Нагрузочный стенд для bot.py.
+
+Поднимает два фейковых сервера — Lify API (/Chat, /Chat/{id}, /Chat/Count)
+и Telegram Bot API — запускает настоящий стек бота (вебхук, диспетчер,
+планировщик опроса, исходящую очередь) и гонит в вебхук синтетические
+апдейты с заданной частотой от заданного числа пользователей.
+
+Пример:
+    python bench.py --users 200 --rate 50 --duration 30 --ttr 3
+"""
+import argparse
+import asyncio
+import base64
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import statistics
+import time
+import tracemalloc
+from collections import Counter
+
+import httpx
+import tornado.web
+from tornado.httpserver import HTTPServer
+
+BENCH_BOT_TOKEN = "123456:bench"
+
+
+# Фейковый Lify API: ответ готов через time-to-ready после POST /Chat
+class FakeLifyApi:
+    def __init__(self, ttr, ttr_jitter, latency):
+        self.ttr = ttr
+        self.ttr_jitter = ttr_jitter
+        self.latency = latency
+        self.requests = Counter()
+        self._ids = itertools.count(1)
+        self._messages = {}  # id → (question, ready_at)
+        self._latest = None
+
+    def answer(self, message_id):
+        question, ready_at = self._messages[message_id]
+        if time.monotonic() < ready_at:
+            return {"id": message_id, "type": 1, "message": question}
+        self._latest = {"id": message_id, "type": 0, "message": f"answer:{question}"}
+        return self._latest
+
+    def make_app(self):
+        api = self
+
+        class Base(tornado.web.RequestHandler):
+            async def prepare(self):
+                if api.latency:
+                    await asyncio.sleep(api.latency)
+
+        class ChatHandler(Base):
+            def post(self):
+                api.requests["POST /Chat"] += 1
+                question = json.loads(self.request.body)["Message"]
+                message_id = str(next(api._ids))
+                ttr = max(0.0, random.gauss(api.ttr, api.ttr_jitter))
+                api._messages[message_id] = (question, time.monotonic() + ttr)
+                self.write({"id": message_id, "type": 1, "message": question})
+
+        class ChatItemHandler(Base):
+            def get(self, message_id):
+                api.requests["GET /Chat/{id}"] += 1
+                if message_id not in api._messages:
+                    self.set_status(404)
+                    self.write("not found")
+                    return
+                self.write(api.answer(message_id))
+
+        class ChatCountHandler(Base):
+            def get(self, count, offset):
+                api.requests["GET /Chat/Count"] += 1
+                self.set_header("Content-Type", "application/json")
+                self.write(json.dumps([api._latest] if api._latest else []))
+
+        return tornado.web.Application([
+            (r"/api/Chat/?", ChatHandler),
+            (r"/api/Chat/Count/(\d+)/(\d+)", ChatCountHandler),
+            (r"/api/Chat/([^/]+)", ChatItemHandler),
+        ])
+
+
+# Фейковый Telegram Bot API: запоминает, когда в чат пришёл ответ
+class FakeTelegram:
+    def __init__(self, latency):
+        self.latency = latency
+        self.requests = Counter()
+        self.answered = {}  # question → monotonic времени доставки ответа
+        self._ids = itertools.count(1)
+
+    def make_app(self):
+        tg = self
+
+        class MethodHandler(tornado.web.RequestHandler):
+            async def post(self, token, method):
+                if tg.latency:
+                    await asyncio.sleep(tg.latency)
+                tg.requests[method] += 1
+                if self.request.headers.get("Content-Type", "").startswith("application/json"):
+                    params = json.loads(self.request.body or b"{}")
+                else:
+                    params = {key: self.get_body_argument(key) for key in self.request.body_arguments}
+                self.write({"ok": True, "result": tg.handle(method, params)})
+
+        return tornado.web.Application([(r"/bot([^/]+)/(\w+)", MethodHandler)])
+
+    def handle(self, method, params):
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot",
+                    "can_join_groups": False, "can_read_all_group_messages": False,
+                    "supports_inline_queries": False}
+        if method in ("sendMessage", "editMessageText"):
+            text = params.get("text", "")
+            if "answer:" in text:
+                self.answered.setdefault(text.rsplit("answer:", 1)[1].strip(), time.monotonic())
+            message_id = int(params["message_id"]) if "message_id" in params else next(self._ids)
+            return {"message_id": message_id, "date": int(time.time()), "text": text,
+                    "chat": {"id": int(params["chat_id"]), "type": "private"}}
+        return True
+
+
+def fake_jwt(user_id):
+    payload = json.dumps({"sub": str(user_id), "exp": int(time.time()) + 3600}).encode()
+    return "eyJhbGciOiJub25lIn0." + base64.urlsafe_b64encode(payload).decode().rstrip("=") + ".sig"
+
+
+def make_update(update_id, user_id, text):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+            "text": text,
+        },
+    }
+
+
+# Фейковые серверы и генератор нагрузки живут в отдельном процессе: общий
+# GIL и общая куча искажали бы задержки цикла бота и замер его памяти.
+# Бенчмарк управляет стендом по HTTP на --control-port.
+class StandIns:
+    def __init__(self, args):
+        self.args = args
+        self.api = FakeLifyApi(args.ttr, args.ttr_jitter, args.api_latency)
+        self.telegram = FakeTelegram(args.tg_latency)
+        self.sent = {}  # question → monotonic отправки апдейта
+        self.users = list(range(1000, 1000 + args.users))
+        self._update_ids = itertools.count(1)
+
+    async def listen(self):
+        HTTPServer(self.api.make_app()).listen(self.args.api_port, "127.0.0.1")
+        HTTPServer(self.telegram.make_app()).listen(self.args.tg_port, "127.0.0.1")
+        HTTPServer(self.make_control_app()).listen(self.args.control_port, "127.0.0.1")
+
+    def stats(self):
+        return {
+            "api_requests": dict(self.api.requests),
+            "telegram_requests": dict(self.telegram.requests),
+            "sent": len(self.sent),
+            "answered": sum(1 for question in self.sent if question in self.telegram.answered),
+        }
+
+    def results(self):
+        answered = self.telegram.answered
+        latencies = [answered[q] - sent for q, sent in self.sent.items() if q in answered]
+        answered_at = [answered[q] for q in self.sent if q in answered]
+        elapsed = (max(answered_at) - min(self.sent.values())) if answered_at else 0.0
+        return {"latencies": latencies, "elapsed": elapsed}
+
+    def make_control_app(self):
+        stand = self
+
+        class ReplayHandler(tornado.web.RequestHandler):
+            async def post(self):
+                tokens = self.get_query_argument("tokens", "0") == "1"
+                await stand.replay(stand.args.rate, stand.args.duration, tokens=tokens)
+                self.write({})
+
+        class StatsHandler(tornado.web.RequestHandler):
+            def get(self):
+                self.write(stand.stats())
+
+        class ResultsHandler(tornado.web.RequestHandler):
+            def get(self):
+                self.write(stand.results())
+
+        return tornado.web.Application([
+            (r"/replay", ReplayHandler),
+            (r"/stats", StatsHandler),
+            (r"/results", ResultsHandler),
+        ])
+
+    async def replay(self, rate, duration, tokens=False):
+        webhook = f"http://127.0.0.1:{self.args.webhook_port}/webhook"
+        limits = httpx.Limits(max_connections=200)
+        async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+            async def post(user_id, text):
+                await client.post(webhook, json=make_update(next(self._update_ids), user_id, text))
+
+            if tokens:
+                await asyncio.gather(*(post(user_id, fake_jwt(user_id)) for user_id in self.users))
+                return
+
+            tasks = []
+            started = time.monotonic()
+            for n in itertools.count():
+                at = started + n / rate
+                if at - started >= duration:
+                    break
+                await asyncio.sleep(max(0.0, at - time.monotonic()))
+                question = f"q{n}"
+                self.sent[question] = time.monotonic()
+                tasks.append(asyncio.create_task(post(random.choice(self.users), question)))
+            await asyncio.gather(*tasks)
+
+
+def run_stand_ins(args, ready):
+    async def serve():
+        await StandIns(args).listen()
+        ready.set()
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+# Процесс стенда со стороны бенчмарка
+class StandInsProcess:
+    def __init__(self, args):
+        ctx = multiprocessing.get_context("spawn")
+        self._ready = ctx.Event()
+        self._process = ctx.Process(target=run_stand_ins, args=(args, self._ready), name="bench-stand-ins", daemon=True)
+        self._control = f"http://127.0.0.1:{args.control_port}"
+
+    def start(self):
+        self._process.start()
+        if not self._ready.wait(30):
+            self.stop()
+            raise RuntimeError("Стенд не запустился за 30 s")
+
+    def stop(self):
+        self._process.terminate()
+        self._process.join()
+
+    async def _call(self, method, path, **params):
+        async with httpx.AsyncClient(timeout=None) as client:
+            resp = await client.request(method, self._control + path, params=params)
+            resp.raise_for_status()
+            return resp.json()
+
+    async def replay(self, tokens=False):
+        await self._call("POST", "/replay", tokens=int(tokens))
+
+    async def stats(self):
+        return await self._call("GET", "/stats")
+
+    async def results(self):
+        return await self._call("GET", "/results")
+
+
+async def sample_loop_lag(samples, interval=0.05):
+    while True:
+        started = time.monotonic()
+        await asyncio.sleep(interval)
+        samples.append(time.monotonic() - started - interval)
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+async def bench(args, stand):
+    import bot  # после настройки окружения в main()
+
+    app = bot.build_application(base_url=f"http://127.0.0.1:{args.tg_port}/bot")
+    await app.initialize()
+    await bot.post_init(app)
+    await app.updater.start_webhook(
+        listen="127.0.0.1",
+        port=args.webhook_port,
+        url_path="/webhook",
+        webhook_url=f"http://127.0.0.1:{args.webhook_port}/webhook"
+    )
+    await app.start()
+
+    lag = []
+    lag_task = asyncio.create_task(sample_loop_lag(lag))
+    try:
+        # Прогрев: все пользователи присылают токен
+        await stand.replay(tokens=True)
+        warmup_deadline = time.monotonic() + args.timeout
+        while (confirmed := (await stand.stats())["telegram_requests"].get("sendMessage", 0)) < args.users:
+            # "✅ Токен сохранён!" каждому
+            if time.monotonic() >= warmup_deadline:
+                raise RuntimeError(
+                    f"Прогрев не завершился за {args.timeout:g} s: токен подтверждён "
+                    f"{confirmed} из {args.users} пользователей"
+                )
+            await asyncio.sleep(0.05)
+        before = await stand.stats()
+        lag.clear()
+
+        if args.memory:
+            tracemalloc.start()
+        memory_base = tracemalloc.get_traced_memory()[0] if args.memory else 0
+        peak_pending, memory_at_peak = 0, 0
+
+        load = asyncio.create_task(stand.replay())
+        deadline = time.monotonic() + args.duration + args.timeout
+        while time.monotonic() < deadline:
+            pending = len(bot.poll_scheduler)
+            if pending > peak_pending:
+                peak_pending = pending
+                if args.memory:
+                    memory_at_peak = tracemalloc.get_traced_memory()[0]
+            if load.done():
+                # Опрашиваем стенд только после подачи нагрузки, чтобы не мешать замеру
+                stats = await stand.stats()
+                if stats["answered"] >= stats["sent"]:
+                    break
+            await asyncio.sleep(0.1)
+        await load
+        if args.memory:
+            tracemalloc.stop()
+    finally:
+        lag_task.cancel()
+        await app.updater.stop()
+        await app.stop()
+        await app.shutdown()
+        await bot.post_shutdown(app)
+
+    stats = await stand.stats()
+    results = await stand.results()
+    questions = stats["sent"]
+    latencies, elapsed = results["latencies"], results["elapsed"]
+    api_requests = sum(stats["api_requests"].values()) - sum(before["api_requests"].values())
+    tg_requests = sum(stats["telegram_requests"].values()) - sum(before["telegram_requests"].values())
+    return {
+        "questions": questions,
+        "answered": len(latencies),
+        "throughput_per_s": len(latencies) / elapsed if elapsed else 0.0,
+        "answer_p50_s": percentile(latencies, 0.50),
+        "answer_p95_s": percentile(latencies, 0.95),
+        "answer_p99_s": percentile(latencies, 0.99),
+        "answer_mean_s": statistics.fmean(latencies) if latencies else 0.0,
+        "api_requests_per_question": api_requests / questions if questions else 0.0,
+        "api_requests": stats["api_requests"],
+        "telegram_requests_per_question": tg_requests / questions if questions else 0.0,
+        "telegram_requests": stats["telegram_requests"],
+        "loop_lag_p99_ms": percentile(lag, 0.99) * 1000,
+        "loop_lag_max_ms": max(lag, default=0.0) * 1000,
+        "peak_pending": peak_pending,
+        "memory_per_pending_bytes": (memory_at_peak - memory_base) / peak_pending if args.memory and peak_pending else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест bot.py на фейковых Lify API и Telegram")
+    parser.add_argument("--users", type=int, default=100, help="число пользователей")
+    parser.add_argument("--rate", type=float, default=20, help="вопросов в секунду, всего")
+    parser.add_argument("--duration", type=float, default=20, help="длительность подачи нагрузки, s")
+    parser.add_argument("--ttr", type=float, default=3, help="среднее время готовности ответа в API, s")
+    parser.add_argument("--ttr-jitter", type=float, default=1, help="стандартное отклонение ttr, s")
+    parser.add_argument("--api-latency", type=float, default=0.01, help="задержка каждого ответа API, s")
+    parser.add_argument("--tg-latency", type=float, default=0.02, help="задержка каждого ответа Bot API, s")
+    parser.add_argument("--timeout", type=float, default=120, help="сколько ждать ответы после нагрузки, s")
+    parser.add_argument("--memory", action="store_true", help="мерить память на ожидающий чат (tracemalloc)")
+    parser.add_argument("--json", action="store_true", help="вывести результат в JSON")
+    parser.add_argument("--api-port", type=int, default=18081)
+    parser.add_argument("--tg-port", type=int, default=18082)
+    parser.add_argument("--webhook-port", type=int, default=18083)
+    parser.add_argument("--control-port", type=int, default=18084, help="управление процессом стенда")
+    args = parser.parse_args()
+
+    # bot.py читает настройки при импорте — направляем его на стенд
+    os.environ.update({
+        "TELEGRAM_BOT_TOKEN": BENCH_BOT_TOKEN,
+        "API_BASE_URL": f"http://127.0.0.1:{args.api_port}/api",
+        "TOKEN_STORE": "memory",
+        "POLL_JOURNAL": "0",
+    })
+
+    stand = StandInsProcess(args)
+    stand.start()
+    try:
+        result = asyncio.run(bench(args, stand))
+    except RuntimeError as e:
+        parser.exit(1, f"bench.py: {e}\n")
+    finally:
+        stand.stop()
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+    for key, value in result.items():
+        print(f"{key:32} {value:.3f}" if isinstance(value, float) else f"{key:32} {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,31 @@
 import json
 import os
-import requests
 import asyncio
+import base64
+import bisect
+import contextvars
+import heapq
+import itertools
+import logging
+import multiprocessing
+import random
+import signal
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from queue import Empty
+import httpx
+import tornado.web
+from tornado.httpserver import HTTPServer
 from telegram import Update
+from telegram.constants import MessageLimit
+from telegram.error import BadRequest, NetworkError, RetryAfter
 from telegram.ext import (
+    Application,
     ApplicationBuilder,
     CommandHandler,
     MessageHandler,
@@ -19,15 +41,1308 @@ WEBHOOK_HOST = os.getenv("WEBHOOK_HOST")
 WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
 PORT = int(os.environ.get("PORT", 8443))
 
-API_BASE_URL = "https://api.totothemoon.site/api"
-POLLING_INTERVAL = 5  # seconds
+API_BASE_URL = os.getenv("API_BASE_URL", "https://api.totothemoon.site/api")
 
-# Хранилище user_id → JWT токен
-user_tokens = {}
+# Настройки планировщика опроса ответов
+POLL_FIRST_DELAY = float(os.getenv("POLL_FIRST_DELAY", 1))  # seconds
+POLL_MAX_INTERVAL = float(os.getenv("POLL_MAX_INTERVAL", 8))  # seconds
+POLL_BACKOFF = 2
+POLL_JITTER = 0.2  # ±20% к интервалу
+POLL_DEADLINE = float(os.getenv("POLL_DEADLINE", 300))  # seconds
+POLL_MAX_RPS = float(os.getenv("POLL_MAX_RPS", 20))  # GET /Chat/{id} в секунду на весь бот
+
+# Доставка ответа: "edit" — редактируем сообщение "Обрабатываю запрос...",
+# "send" — отправляем ответ отдельным сообщением
+DELIVERY_MODE = os.getenv("DELIVERY_MODE", "edit")
+EDIT_MIN_INTERVAL = float(os.getenv("EDIT_MIN_INTERVAL", 1.5))  # seconds между правками одного сообщения
+API_PARTIAL_FIELD = "partial"  # частичный текст ответа, если бэкенд его отдаёт
+
+# Повторы одного и того же вопроса: пока ждём ответ — не спрашиваем бэкенд
+# заново, ответ на последний вопрос пользователя отдаём из кэша в течение
+# ANSWER_CACHE_TTL
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", 60))  # seconds, 0 — без кэша
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", 10_000))  # пользователей
+
+# Настройки HTTP-клиента Lify API
+API_TIMEOUT = float(os.getenv("API_TIMEOUT", 15))  # seconds
+API_CONNECT_TIMEOUT = float(os.getenv("API_CONNECT_TIMEOUT", 5))  # seconds
+API_MAX_CONNECTIONS = int(os.getenv("API_MAX_CONNECTIONS", 100))
+API_MAX_KEEPALIVE = int(os.getenv("API_MAX_KEEPALIVE", 20))
+API_MAX_CONCURRENCY = int(os.getenv("API_MAX_CONCURRENCY", 64))
+
+# Исходящая очередь Telegram: общий лимит ~30 msg/s и лимит на чат
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", 25))  # сообщений в секунду
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", 1))  # сообщений в секунду на чат
+SEND_CHAT_BURST = int(os.getenv("SEND_CHAT_BURST", 3))
+SEND_RETRY_DELAY = 1  # seconds, первая пауза после сетевой ошибки
+SEND_MAX_RETRY_DELAY = 30  # seconds
+SEND_MAX_ATTEMPTS = 6  # сетевых ошибок подряд, после которых сообщение не доставляем
+SEND_DRAIN_TIMEOUT = 10  # seconds на досылку очереди при остановке
+
+# Приоритеты исходящих сообщений: меньше — раньше
+PRIORITY_ANSWER = 0
+PRIORITY_STATUS = 1
+PRIORITY_ERROR = 2
+PRIORITY_NAMES = {PRIORITY_ANSWER: "answer", PRIORITY_STATUS: "status", PRIORITY_ERROR: "error"}
+
+# Параллельная обработка апдейтов: разные чаты — параллельно, один чат — строго по очереди
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", 32))
+UPDATE_QUEUE_LIMIT = int(os.getenv("UPDATE_QUEUE_LIMIT", 1000))
+UPDATE_DRAIN_TIMEOUT = 10  # seconds на доработку принятых апдейтов при остановке
+
+# Хранилище токенов: "sqlite" (переживает перезапуск) или "memory"
+TOKEN_STORE = os.getenv("TOKEN_STORE", "sqlite")
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", "lify_state.sqlite3")
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", 100_000))
+TOKEN_FLUSH_INTERVAL = float(os.getenv("TOKEN_FLUSH_INTERVAL", 1))  # seconds
+TOKEN_SWEEP_INTERVAL = 60  # seconds
+
+# Журнал ожидающих ответов в STATE_DB_PATH: после падения или при выкатке
+# незавершённые опросы подхватывает другой (или новый) процесс
+POLL_JOURNAL = os.getenv("POLL_JOURNAL", "1") == "1"
+JOURNAL_FLUSH_INTERVAL = 0.5  # seconds
+JOURNAL_HEARTBEAT_INTERVAL = 5  # seconds
+JOURNAL_STALE_AFTER = 30  # seconds без heartbeat — процесс считаем мёртвым
+UPDATE_DEDUP_SIZE = 10_000  # update_id, которые помним в памяти
+UPDATE_DEDUP_TTL = 24 * 3600  # seconds, сколько помним update_id в журнале
+
+# Шардированный режим: роутер на порту вебхука и WEBHOOK_WORKERS процессов,
+# каждый чат всегда обрабатывает один и тот же процесс
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 1))
+WORKER_RESTART_INTERVAL = 5  # seconds между проверками живости воркеров
+
+# Метрики и трассировка
+METRICS_PATH = os.getenv("METRICS_PATH", "/metrics")  # пусто — не отдавать /metrics
+METRICS_WORKER_PORT = int(os.getenv("METRICS_WORKER_PORT", 0))  # шардированный режим: порт + номер воркера
+TRACE_IDS = os.getenv("TRACE_IDS", "0") == "1"
+LOOP_LAG_INTERVAL = 0.5  # seconds
+
+logger = logging.getLogger(__name__)
+
+# trace id текущего апдейта; попадает во все логи, если включён TRACE_IDS
+trace_id_var = contextvars.ContextVar("trace_id", default="-")
+
+
+def setup_logging(prefix=""):
+    trace = " [%(trace_id)s]" if TRACE_IDS else ""
+    logging.basicConfig(
+        format=f"%(asctime)s %(levelname)s {prefix}%(name)s{trace}: %(message)s",
+        level=logging.INFO
+    )
+    if TRACE_IDS:
+        make_record = logging.getLogRecordFactory()
+
+        def record_with_trace_id(*args, **kwargs):
+            record = make_record(*args, **kwargs)
+            record.trace_id = trace_id_var.get()
+            return record
+
+        logging.setLogRecordFactory(record_with_trace_id)
+
+
+def new_trace_id():
+    return uuid.uuid4().hex[:12] if TRACE_IDS else "-"
+
+
+# Метрики в формате Prometheus. Запись — это пара словарных операций,
+# так что на горячем пути они практически бесплатны.
+METRICS = []
+
+
+def _labels(names, values, extra=""):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        METRICS.append(self)
+
+    def inc(self, *label_values, value=1):
+        self._values[label_values] = self._values.get(label_values, 0) + value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for label_values, value in list(self._values.items()):
+            yield f"{self.name}{_labels(self.labels, label_values)} {value}"
+
+
+class Gauge:
+    kind = "gauge"
+
+    def __init__(self, name, help, read):
+        self.name = name
+        self.help = help
+        self._read = read  # () → число
+        METRICS.append(self)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+        yield f"{self.name} {self._read()}"
+
+
+# Счётчик, который считает не сам, а читает готовое значение при отдаче метрик
+class CounterFunc(Gauge):
+    kind = "counter"
+
+
+class Histogram:
+    def __init__(self, name, help, buckets, labels=()):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.labels = labels
+        self._series = {}  # label values → [счётчики по бакетам, сумма, количество]
+        METRICS.append(self)
+
+    def observe(self, value, *label_values):
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[0][index] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for label_values, (counts, total, count) in list(self._series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = _labels(self.labels, label_values, f'le="{bound}"')
+                yield f"{self.name}_bucket{le} {cumulative}"
+            le = _labels(self.labels, label_values, 'le="+Inf"')
+            yield f"{self.name}_bucket{le} {count}"
+            yield f"{self.name}_sum{_labels(self.labels, label_values)} {total}"
+            yield f"{self.name}_count{_labels(self.labels, label_values)} {count}"
+
+
+def render_metrics():
+    return "\n".join(line for metric in METRICS for line in metric.render()) + "\n"
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(render_metrics())
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+STAGE_SECONDS = Histogram(
+    "lify_stage_seconds",
+    "Длительность этапов обработки: handle_message, render, telegram_queue, telegram_send, answer",
+    LATENCY_BUCKETS, labels=("stage",)
+)
+OUTBOUND_DELIVERY_SECONDS = Histogram(
+    "lify_outbound_delivery_seconds", "От постановки в исходящую очередь до доставки в Telegram: answer, status, error",
+    LATENCY_BUCKETS, labels=("priority",)
+)
+API_REQUEST_SECONDS = Histogram(
+    "lify_api_request_seconds", "Длительность запросов к Lify API", LATENCY_BUCKETS, labels=("route",)
+)
+API_RESPONSES = Counter("lify_api_responses_total", "Ответы Lify API по статусам", labels=("route", "status"))
+POLL_ITERATIONS = Histogram(
+    "lify_poll_iterations", "Число GET /Chat/{id} на один ответ", (1, 2, 3, 4, 5, 6, 8, 10, 15, 20, 30, 50)
+)
+COALESCED = Counter("lify_coalesced_total", "Повторные вопросы без запроса к API: inflight, cache", labels=("result",))
+TOKEN_LOOKUPS = Counter("lify_token_store_lookups_total", "Поиск токена: hit, miss, backend_hit, backend_miss", labels=("result",))
+LOOP_LAG_SECONDS = Histogram(
+    "lify_event_loop_lag_seconds", "Опоздание event loop относительно запланированного пробуждения",
+    (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+)
+
+
+async def sample_event_loop_lag(interval=LOOP_LAG_INTERVAL):
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        LOOP_LAG_SECONDS.observe(max(0.0, loop.time() - started - interval))
+
+
+# Срок действия JWT (claim exp, unix time) или None, если его нет
+def jwt_expiry(token):
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        exp = json.loads(base64.urlsafe_b64decode(payload)).get("exp")
+        return float(exp) if exp is not None else None
+    except (IndexError, ValueError, TypeError, AttributeError):
+        return None
+
+
+# Бэкенды хранилища токенов. Методы синхронные — TokenStore вызывает их
+# в отдельном потоке, чтобы не блокировать event loop.
+class MemoryTokenBackend:
+    def __init__(self):
+        self._rows = {}
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def load_recent(self, limit, now):
+        rows = [(user_id, token, exp) for user_id, (token, exp) in self._rows.items()
+                if exp is None or exp > now]
+        return rows[-limit:]
+
+    def count(self, now):
+        return len(self.load_recent(len(self._rows), now))
+
+    def get(self, user_id):
+        row = self._rows.get(user_id)
+        return (user_id, *row) if row else None
+
+    def write_batch(self, puts, deletes):
+        for user_id, token, exp in puts:
+            self._rows[user_id] = (token, exp)
+        for user_id in deletes:
+            self._rows.pop(user_id, None)
+
+    def delete_expired(self, now):
+        expired = [user_id for user_id, (_, exp) in self._rows.items() if exp is not None and exp <= now]
+        self.write_batch([], expired)
+
+
+class SqliteTokenBackend:
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def open(self):
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS tokens ("
+            " user_id INTEGER PRIMARY KEY,"
+            " token TEXT NOT NULL,"
+            " exp REAL,"
+            " updated_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def load_recent(self, limit, now):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT user_id, token, exp FROM tokens WHERE exp IS NULL OR exp > ?"
+                " ORDER BY updated_at DESC LIMIT ?", (now, limit)
+            ).fetchall()
+        return rows[::-1]
+
+    def count(self, now):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM tokens WHERE exp IS NULL OR exp > ?", (now,)
+            ).fetchone()[0]
+
+    def get(self, user_id):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT user_id, token, exp FROM tokens WHERE user_id = ?", (user_id,)
+            ).fetchone()
+
+    def write_batch(self, puts, deletes):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO tokens (user_id, token, exp, updated_at) VALUES (?, ?, ?, ?)",
+                [(user_id, token, exp, now) for user_id, token, exp in puts]
+            )
+            self._conn.executemany("DELETE FROM tokens WHERE user_id = ?", [(user_id,) for user_id in deletes])
+
+    def delete_expired(self, now):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM tokens WHERE exp IS NOT NULL AND exp <= ?", (now,))
+
+
+# Хранилище user_id → JWT токен: LRU-кэш в памяти поверх постоянного бэкенда.
+# Чтение на горячем пути — только из памяти; записи копятся и сбрасываются
+# на диск пачками в фоне; истёкшие по exp токены вычищаются заранее.
+class TokenStore:
+    def __init__(self, backend, cache_size=TOKEN_CACHE_SIZE, flush_interval=TOKEN_FLUSH_INTERVAL, shared=False):
+        self._backend = backend
+        self._cache_size = cache_size
+        self._flush_interval = flush_interval
+        self._shared = shared  # в бэкенд пишут и другие процессы
+        self._cache = OrderedDict()  # user_id → (token, exp)
+        self._dirty = {}  # user_id → (token, exp) или None для удаления
+        self._complete = not shared  # в кэше лежат все живые токены бэкенда
+        self._flush_event = asyncio.Event()
+        self._tasks = []
+
+    def __len__(self):
+        return len(self._cache)
+
+    async def start(self):
+        await asyncio.to_thread(self._backend.open)
+        now = time.time()
+        rows = await asyncio.to_thread(self._backend.load_recent, self._cache_size, now)
+        for user_id, token, exp in rows:
+            self._cache[user_id] = (token, exp)
+        total = await asyncio.to_thread(self._backend.count, now)
+        self._complete = not self._shared and total <= len(self._cache)
+        self._tasks = [asyncio.create_task(self._flusher()), asyncio.create_task(self._sweeper())]
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self.flush()
+        await asyncio.to_thread(self._backend.close)
+
+    def get(self, user_id):
+        entry = self._cache.get(user_id)
+        if entry is None:
+            TOKEN_LOOKUPS.inc("miss")
+            return None
+        token, exp = entry
+        if exp is not None and exp <= time.time():
+            self.delete(user_id)
+            TOKEN_LOOKUPS.inc("miss")
+            return None
+        self._cache.move_to_end(user_id)
+        TOKEN_LOOKUPS.inc("hit")
+        return token
+
+    async def load(self, user_id):
+        """После промаха get(): подгрузка из бэкенда, если токен мог быть вытеснен из кэша."""
+        if self._complete or user_id in self._dirty:
+            return None
+        row = await asyncio.to_thread(self._backend.get, user_id)
+        TOKEN_LOOKUPS.inc("backend_miss" if row is None else "backend_hit")
+        if row is None:
+            return None
+        _, token, exp = row
+        if exp is not None and exp <= time.time():
+            return None
+        self._remember(user_id, token, exp)
+        return token
+
+    def put(self, user_id, token):
+        exp = jwt_expiry(token)
+        self._remember(user_id, token, exp)
+        self._dirty[user_id] = (token, exp)
+        self._flush_event.set()
+        return exp
+
+    def delete(self, user_id):
+        self._cache.pop(user_id, None)
+        self._dirty[user_id] = None
+        self._flush_event.set()
+
+    def _remember(self, user_id, token, exp):
+        self._cache[user_id] = (token, exp)
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+            self._complete = False
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, {}
+        puts = [(user_id, *entry) for user_id, entry in dirty.items() if entry is not None]
+        deletes = [user_id for user_id, entry in dirty.items() if entry is None]
+        try:
+            await asyncio.to_thread(self._backend.write_batch, puts, deletes)
+        except Exception:
+            logger.exception("Token store flush failed, will retry")
+            # Не затираем записи, сделанные во время неудачного сброса
+            self._dirty = {**dirty, **self._dirty}
+
+    async def _flusher(self):
+        while True:
+            await self._flush_event.wait()
+            await asyncio.sleep(self._flush_interval)  # копим пачку
+            self._flush_event.clear()
+            await self.flush()
+
+    async def _sweeper(self):
+        while True:
+            await asyncio.sleep(TOKEN_SWEEP_INTERVAL)
+            now = time.time()
+            expired = [user_id for user_id, (_, exp) in self._cache.items() if exp is not None and exp <= now]
+            for user_id in expired:
+                self._cache.pop(user_id, None)
+            try:
+                await asyncio.to_thread(self._backend.delete_expired, now)
+            except Exception:
+                logger.exception("Token store sweep failed")
+
+
+def make_token_backend():
+    if TOKEN_STORE == "memory":
+        return MemoryTokenBackend()
+    return SqliteTokenBackend(STATE_DB_PATH)
+
+
+# Шардированный режим: SQLite-файл общий, токен мог сохранить другой воркер
+token_store = TokenStore(make_token_backend(), shared=WEBHOOK_WORKERS > 1)
+
+
+# Журнал ожидающих ответов, общий для всех процессов на хосте (SQLite).
+# Каждая запись принадлежит процессу-владельцу; записи процессов, которые
+# перестали слать heartbeat или отпустили их при остановке, забирает
+# любой живой процесс и продолжает опрос.
+class PollJournal:
+    def __init__(self, path, enabled=POLL_JOURNAL):
+        self.path = path
+        self.enabled = enabled
+        # hostname и pid повторяются после рестарта контейнера — nonce отличает
+        # новый процесс от упавшего, чьи записи нужно забрать
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:12]}"
+        self._conn = None
+        self._lock = threading.Lock()
+        self._dirty = {}  # message_id → запись или None для удаления
+        self._task = None
+
+    # Синхронная часть — вызывается через asyncio.to_thread
+    def _open(self):
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS pending ("
+            " message_id TEXT PRIMARY KEY,"
+            " user_id INTEGER NOT NULL,"
+            " chat_id INTEGER NOT NULL,"
+            " placeholder_id INTEGER,"
+            " jwt_token TEXT NOT NULL,"
+            " deadline_at REAL NOT NULL,"
+            " owner TEXT)"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS workers (owner TEXT PRIMARY KEY, heartbeat_at REAL NOT NULL)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS updates (update_id INTEGER PRIMARY KEY, seen_at REAL NOT NULL)")
+
+    def _write_batch(self, dirty):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for message_id, row in dirty.items():
+                    if row is None:
+                        self._conn.execute("DELETE FROM pending WHERE message_id = ?", (message_id,))
+                    else:
+                        self._conn.execute(
+                            "INSERT OR REPLACE INTO pending VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            (message_id, *row, self.owner)
+                        )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _heartbeat_and_claim(self, now):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute("INSERT OR REPLACE INTO workers VALUES (?, ?)", (self.owner, now))
+                self._conn.execute("DELETE FROM workers WHERE heartbeat_at < ?", (now - JOURNAL_STALE_AFTER,))
+                self._conn.execute("DELETE FROM updates WHERE seen_at < ?", (now - UPDATE_DEDUP_TTL,))
+                rows = self._conn.execute(
+                    "SELECT message_id, user_id, chat_id, placeholder_id, jwt_token, deadline_at FROM pending"
+                    " WHERE owner IS NULL OR owner NOT IN (SELECT owner FROM workers)"
+                ).fetchall()
+                self._conn.executemany(
+                    "UPDATE pending SET owner = ? WHERE message_id = ?",
+                    [(self.owner, row[0]) for row in rows]
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return rows
+
+    def _release(self):
+        with self._lock:
+            self._conn.execute("UPDATE pending SET owner = NULL WHERE owner = ?", (self.owner,))
+            self._conn.execute("DELETE FROM workers WHERE owner = ?", (self.owner,))
+
+    def _claim_update(self, update_id, now):
+        with self._lock:
+            cursor = self._conn.execute("INSERT OR IGNORE INTO updates VALUES (?, ?)", (update_id, now))
+        return cursor.rowcount == 1
+
+    # Асинхронный интерфейс
+    async def start(self):
+        if self.enabled:
+            await asyncio.to_thread(self._open)
+
+    def run(self, on_resume):
+        """Запускает heartbeat, сброс записей и подхват чужих опросов."""
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._maintain(on_resume))
+
+    async def close(self):
+        if not self.enabled or self._conn is None:
+            return
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+        # Отпускаем свои записи, чтобы их сразу подхватил другой процесс
+        await asyncio.to_thread(self._release)
+        self._conn.close()
+        self._conn = None
+
+    def record(self, pending):
+        if self.enabled:
+            deadline_at = time.time() + (pending.deadline - time.monotonic())
+            self._dirty[pending.message_id] = (
+                pending.user_id, pending.chat_id, pending.placeholder_id, pending.jwt_token, deadline_at
+            )
+
+    def complete(self, message_id):
+        if self.enabled:
+            self._dirty[message_id] = None
+
+    async def claim_update(self, update_id):
+        """True, если этот update_id ещё никто не обрабатывал."""
+        if not self.enabled:
+            return True
+        return await asyncio.to_thread(self._claim_update, update_id, time.time())
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, {}
+        try:
+            await asyncio.to_thread(self._write_batch, dirty)
+        except Exception:
+            logger.exception("Poll journal flush failed, will retry")
+            self._dirty = {**dirty, **self._dirty}
+
+    async def _maintain(self, on_resume):
+        next_heartbeat = 0.0
+        while True:
+            await self.flush()
+            if time.monotonic() >= next_heartbeat:
+                next_heartbeat = time.monotonic() + JOURNAL_HEARTBEAT_INTERVAL
+                try:
+                    rows = await asyncio.to_thread(self._heartbeat_and_claim, time.time())
+                    if rows:
+                        logger.info("Resuming %d pending polls from the journal", len(rows))
+                        on_resume(rows)
+                except Exception:
+                    logger.exception("Poll journal heartbeat failed")
+            await asyncio.sleep(JOURNAL_FLUSH_INTERVAL)
+
+
+poll_journal = PollJournal(STATE_DB_PATH)
+
+
+# Повторные доставки одного апдейта (Telegram повторяет вебхук, если не
+# получил ответ) отбрасываем по update_id: сначала по памяти, затем по журналу
+class UpdateDeduplicator:
+    def __init__(self, journal, size=UPDATE_DEDUP_SIZE):
+        self._journal = journal
+        self._size = size
+        self._recent = OrderedDict()
+
+    async def first_seen(self, update):
+        if not isinstance(update, Update):
+            return True
+        if update.update_id in self._recent:
+            return False
+        self._recent[update.update_id] = None
+        if len(self._recent) > self._size:
+            self._recent.popitem(last=False)
+        try:
+            return await self._journal.claim_update(update.update_id)
+        except Exception:
+            logger.exception("Update dedup check failed")
+            return True
+
+
+update_dedup = UpdateDeduplicator(poll_journal)
+
+
+# Общий асинхронный клиент Lify API: пул соединений, keep-alive, таймауты
+# и ограничение числа одновременных запросов. Создаётся в post_init и
+# закрывается в post_shutdown вместе с Application.
+class LifyApiClient:
+    def __init__(self, base_url, timeout=API_TIMEOUT, connect_timeout=API_CONNECT_TIMEOUT,
+                 max_connections=API_MAX_CONNECTIONS, max_keepalive=API_MAX_KEEPALIVE,
+                 max_concurrency=API_MAX_CONCURRENCY):
+        self.base_url = base_url.rstrip("/")
+        self._timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self._limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive,
+        )
+        self._max_concurrency = max_concurrency
+        self._client = None
+        self._semaphore = None
+
+    async def start(self):
+        if self._client is not None:
+            return
+        self._client = httpx.AsyncClient(
+            base_url=self.base_url,
+            timeout=self._timeout,
+            limits=self._limits,
+            headers={"Content-Type": "application/json"},
+        )
+        self._semaphore = asyncio.Semaphore(self._max_concurrency)
+
+    async def close(self):
+        if self._client is None:
+            return
+        await self._client.aclose()
+        self._client = None
+
+    async def request(self, method, path, jwt_token, route=None, **kwargs):
+        if self._client is None:
+            raise RuntimeError("LifyApiClient is not started")
+        route = route or f"{method} {path}"
+        headers = {"Authorization": f"Bearer {jwt_token}"}
+        async with self._semaphore:
+            started = time.monotonic()
+            try:
+                resp = await self._client.request(method, path, headers=headers, **kwargs)
+            except httpx.HTTPError:
+                API_RESPONSES.inc(route, "error")
+                raise
+            finally:
+                API_REQUEST_SECONDS.observe(time.monotonic() - started, route)
+        API_RESPONSES.inc(route, str(resp.status_code))
+        return resp
+
+    async def post_chat(self, jwt_token, payload):
+        return await self.request("POST", "/Chat", jwt_token, json=payload)
+
+    async def get_chat(self, jwt_token, message_id):
+        return await self.request("GET", f"/Chat/{message_id}", jwt_token, route="GET /Chat/{id}")
+
+
+lify_api = LifyApiClient(API_BASE_URL)
+
+# Token bucket: не больше rate операций в секунду, всплеск до capacity
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self):
+        """Сколько секунд ждать до появления свободного токена."""
+        self._refill()
+        if self._tokens >= 1:
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+    def idle(self):
+        """Бакет полон — его состояние можно забыть."""
+        self._refill()
+        return self._tokens >= self.capacity
+
+    def try_acquire(self):
+        if self.delay() > 0:
+            return False
+        self._tokens -= 1
+        return True
+
+    async def acquire(self):
+        while not self.try_acquire():
+            await asyncio.sleep(self.delay())
+
+
+# Сообщение, ответ на которое мы ждём
+@dataclass
+class PendingPoll:
+    user_id: int
+    chat_id: int
+    message_id: str
+    jwt_token: str
+    placeholder_id: int = None
+    coalesce_key: tuple = None
+    trace_id: str = "-"
+    deadline: float = 0.0
+    interval: float = 0.0
+    attempts: int = 0
+    created_at: float = field(default_factory=time.monotonic)
+
+
+# Единый планировщик опроса GET /Chat/{id}: один таймер на все ожидающие
+# сообщения, быстрая первая проверка, затем экспоненциальный backoff с jitter,
+# дедлайн на сообщение и общий лимит запросов в секунду к API.
+class PollScheduler:
+    def __init__(self, api, on_ready, on_error, on_partial=None, on_finish=None, journal=None,
+                 first_delay=POLL_FIRST_DELAY, max_interval=POLL_MAX_INTERVAL, deadline=POLL_DEADLINE,
+                 max_rps=POLL_MAX_RPS):
+        self._api = api
+        self._on_ready = on_ready
+        self._on_error = on_error
+        self._on_partial = on_partial
+        self._on_finish = on_finish  # вызывается при любом завершении опроса
+        self._journal = journal
+        self._first_delay = first_delay
+        self._max_interval = max_interval
+        self._deadline = deadline
+        self._bucket = TokenBucket(max_rps)
+        self._heap = []  # (next_check_at, seq, PendingPoll)
+        self._seq = itertools.count()
+        self._pending = {}  # message_id → PendingPoll
+        self._inflight = set()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._application = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def __contains__(self, message_id):
+        return message_id in self._pending
+
+    def start(self, application):
+        self._application = application
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def set_max_rps(self, max_rps):
+        self._bucket = TokenBucket(max_rps)
+
+    async def stop(self):
+        tasks = list(self._inflight)
+        if self._task is not None:
+            tasks.append(self._task)
+            self._task = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def add(self, pending):
+        now = time.monotonic()
+        if not pending.deadline:
+            pending.deadline = now + self._deadline
+        pending.interval = self._first_delay
+        self._pending[pending.message_id] = pending
+        if self._journal is not None:
+            self._journal.record(pending)
+        self._schedule(pending, now + self._first_delay)
+
+    def _finish(self, pending):
+        self._pending.pop(pending.message_id, None)
+        if self._journal is not None:
+            self._journal.complete(pending.message_id)
+        if self._on_finish is not None:
+            self._on_finish(pending)
+
+    def _schedule(self, pending, at):
+        heapq.heappush(self._heap, (min(at, pending.deadline), next(self._seq), pending))
+        self._wakeup.set()
+
+    def _reschedule(self, pending):
+        pending.interval = min(pending.interval * POLL_BACKOFF, self._max_interval)
+        jitter = random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER)
+        self._schedule(pending, time.monotonic() + pending.interval * jitter)
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+
+            delay = self._heap[0][0] - time.monotonic()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            # Сообщения, чей срок проверки наступил, проверяем одной пачкой —
+            # но не больше, чем позволяет лимит запросов; остальные ждут в куче
+            now = time.monotonic()
+            batch = []
+            while self._heap and self._heap[0][0] <= now:
+                pending = self._heap[0][2]
+                # Истёкшим по дедлайну запрос к API не нужен
+                if now < pending.deadline and not self._bucket.try_acquire():
+                    break
+                batch.append(heapq.heappop(self._heap)[2])
+
+            if not batch:
+                await asyncio.sleep(self._bucket.delay())
+                continue
+
+            task = asyncio.create_task(self._check_batch(batch))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _check_batch(self, batch):
+        # У API нет пакетного эндпоинта статусов, поэтому пачка — это
+        # параллельные GET /Chat/{id}, на каждый из которых уже взят токен
+        await asyncio.gather(*(self._check(pending) for pending in batch))
+
+    async def _check(self, pending):
+        trace_id_var.set(pending.trace_id)
+        try:
+            if time.monotonic() >= pending.deadline:
+                await self._on_error(self._application, pending, "⌛ Ответ не пришёл вовремя, попробуй ещё раз.")
+                self._finish(pending)
+                return
+
+            pending.attempts += 1
+            try:
+                resp = await self._api.get_chat(pending.jwt_token, pending.message_id)
+            except httpx.HTTPError as e:
+                logger.warning("GET /Chat/%s failed: %s", pending.message_id, e)
+                self._reschedule(pending)
+                return
+
+            if resp.status_code == 429 or resp.status_code >= 500:
+                self._reschedule(pending)
+                return
+            if resp.status_code != 200:
+                await self._on_error(self._application, pending, f"❌ Ошибка: {resp.text}")
+                self._finish(pending)
+                return
+
+            data = resp.json()
+            if data.get("type") == 1:
+                self._reschedule(pending)
+                partial = data.get(API_PARTIAL_FIELD)
+                if partial and self._on_partial is not None:
+                    try:
+                        await self._on_partial(self._application, pending, partial)
+                    except Exception as e:
+                        # Промежуточная правка не должна обрывать опрос
+                        logger.warning("Partial update for %s failed: %s", pending.message_id, e)
+                return
+
+            await self._on_ready(self._application, pending, data)
+            self._finish(pending)
+            POLL_ITERATIONS.observe(pending.attempts)
+            STAGE_SECONDS.observe(time.monotonic() - pending.created_at, "answer")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception("Polling message %s failed", pending.message_id)
+            try:
+                await self._on_error(self._application, pending, f"❌ Ошибка: {str(e)}")
+            except Exception:
+                logger.exception("Reporting poll failure for %s failed", pending.message_id)
+            self._finish(pending)
+
+
+# Исходящее действие бота (send_message, edit_message_text, ...)
+@dataclass
+class OutboundJob:
+    chat_id: int
+    call: object  # () → coroutine с запросом к Bot API
+    priority: int
+    seq: int
+    future: asyncio.Future
+    trace_id: str = field(default_factory=trace_id_var.get)
+    enqueued_at: float = field(default_factory=time.monotonic)
+    attempts: int = 0
+
+
+# Центральная очередь всех отправок бота. Token bucket на весь бот и на
+# каждый чат, соблюдение retry_after из RetryAfter. Внутри одного чата
+# сообщения уходят строго в порядке постановки; приоритет (ответы раньше
+# статусов и ошибок) решает, какой из готовых чатов обслужить первым.
+# Сетевые ошибки повторяются, так что ответы не теряются под нагрузкой.
+class OutboundQueue:
+    def __init__(self, global_rate=SEND_GLOBAL_RATE, chat_rate=SEND_CHAT_RATE, chat_burst=SEND_CHAT_BURST):
+        self._global = TokenBucket(global_rate)
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._buckets = {}  # chat_id → TokenBucket
+        self._chats = {}  # chat_id → deque заданий в порядке постановки
+        self._ready = []  # heap (priority, seq, chat_id) по первому заданию чатов, которым можно слать сейчас
+        self._active = set()  # чаты в _ready, в ожидании лимита или в процессе отправки
+        self._retry_at = {}  # chat_id → monotonic, раньше которого в чат не шлём
+        self._paused_until = 0.0  # глобальная пауза после RetryAfter
+        self._seq = itertools.count()
+        self._inflight = set()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._bot = None
+        self._stopping = False  # идёт остановка — сетевые ошибки больше не повторяем
+
+    def __len__(self):
+        return sum(len(jobs) for jobs in self._chats.values())
+
+    def start(self, bot):
+        self._bot = bot
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def set_global_rate(self, rate):
+        self._global = TokenBucket(rate)
+
+    def begin_stop(self):
+        self._stopping = True
+
+    async def stop(self):
+        self.begin_stop()
+        deadline = time.monotonic() + SEND_DRAIN_TIMEOUT
+        while (self._chats or self._inflight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._chats:
+            logger.warning("Outbound queue stopped with %d unsent messages", len(self))
+        tasks = list(self._inflight)
+        if self._task is not None:
+            tasks.append(self._task)
+            self._task = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # Не оставляем отправителей ждать вечно
+        for jobs in self._chats.values():
+            for job in jobs:
+                self._fail(job, RuntimeError("Outbound queue stopped"))
+        self._chats.clear()
+        self._ready.clear()
+
+    def submit(self, chat_id, call, priority=PRIORITY_STATUS):
+        job = OutboundJob(chat_id, call, priority, next(self._seq), asyncio.get_running_loop().create_future())
+        self._chats.setdefault(chat_id, deque()).append(job)
+        if chat_id not in self._active:
+            self._activate(chat_id)
+        return job.future
+
+    async def send_message(self, chat_id, text, priority=PRIORITY_STATUS, **kwargs):
+        return await self.submit(
+            chat_id, lambda: self._bot.send_message(chat_id=chat_id, text=text, **kwargs), priority
+        )
+
+    async def edit_message_text(self, chat_id, message_id, text, priority=PRIORITY_STATUS, **kwargs):
+        return await self.submit(
+            chat_id,
+            lambda: self._bot.edit_message_text(text, chat_id=chat_id, message_id=message_id, **kwargs),
+            priority
+        )
+
+    def _bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(self._chat_rate, self._chat_burst)
+        return bucket
+
+    def _activate(self, chat_id):
+        # Ставим чат в очередь готовых, как только это позволит его лимит
+        self._active.add(chat_id)
+        delay = max(self._bucket(chat_id).delay(), self._retry_at.get(chat_id, 0) - time.monotonic())
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, self._make_ready, chat_id)
+        else:
+            self._make_ready(chat_id)
+
+    def _make_ready(self, chat_id):
+        if not self._chats.get(chat_id):
+            return  # очередь остановлена
+        job = self._chats[chat_id][0]
+        heapq.heappush(self._ready, (job.priority, job.seq, chat_id))
+        self._wakeup.set()
+
+    def _release(self, chat_id):
+        if self._chats.get(chat_id):
+            self._activate(chat_id)
+            return
+        self._chats.pop(chat_id, None)
+        self._active.discard(chat_id)
+        self._retry_at.pop(chat_id, None)
+        if self._buckets[chat_id].idle():
+            del self._buckets[chat_id]
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            if not self._ready:
+                await self._wakeup.wait()
+                continue
+
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+
+            await self._global.acquire()
+            _, _, chat_id = heapq.heappop(self._ready)
+            if not self._bucket(chat_id).try_acquire():
+                self._activate(chat_id)
+                continue
+
+            job = self._chats[chat_id].popleft()
+            task = asyncio.create_task(self._deliver(job))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    def _requeue(self, job, delay):
+        self._retry_at[job.chat_id] = time.monotonic() + delay
+        # В чате одновременно отправляется не больше одного сообщения,
+        # так что возвращаем его в начало — порядок не нарушается
+        self._chats[job.chat_id].appendleft(job)
+
+    async def _deliver(self, job):
+        trace_id_var.set(job.trace_id)
+        started = time.monotonic()
+        try:
+            result = await job.call()
+        except RetryAfter as e:
+            # Флуд-лимит Telegram: ждём сами и притормаживаем весь бот
+            logger.warning("Telegram flood limit, retry after %ss", e.retry_after)
+            self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+            self._requeue(job, e.retry_after)
+        except BadRequest as e:
+            self._fail(job, e)
+        except asyncio.CancelledError:
+            self._fail(job, RuntimeError("Outbound queue stopped"))
+            raise
+        except NetworkError as e:
+            job.attempts += 1
+            if self._stopping or job.attempts >= SEND_MAX_ATTEMPTS:
+                logger.warning("Sending to %s failed (%s), giving up after %d attempts", job.chat_id, e, job.attempts)
+                self._fail(job, e)
+                return
+            delay = min(SEND_RETRY_DELAY * 2 ** (job.attempts - 1), SEND_MAX_RETRY_DELAY)
+            logger.warning("Sending to %s failed (%s), retry in %ss", job.chat_id, e, delay)
+            self._requeue(job, delay)
+        except Exception as e:
+            self._fail(job, e)
+        else:
+            now = time.monotonic()
+            OUTBOUND_DELIVERY_SECONDS.observe(now - job.enqueued_at, PRIORITY_NAMES[job.priority])
+            STAGE_SECONDS.observe(now - started, "telegram_send")
+            STAGE_SECONDS.observe(now - job.enqueued_at, "telegram_queue")
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            self._release(job.chat_id)
+
+    @staticmethod
+    def _fail(job, error):
+        if not job.future.done():
+            job.future.set_exception(error)
+
+
+outbox = OutboundQueue()
+
+
+# Ключ, по которому апдейты упорядочиваются: чат, иначе пользователь.
+# Апдейты без чата и пользователя ни с чем не упорядочиваем.
+def update_ordering_key(update):
+    if isinstance(update, Update):
+        if update.effective_chat is not None:
+            return ("chat", update.effective_chat.id)
+        if update.effective_user is not None:
+            return ("user", update.effective_user.id)
+        return ("update", update.update_id)
+    return ("object", id(update))
+
+
+# Ограниченный пул воркеров для апдейтов: у каждого чата своя FIFO-очередь,
+# и в любой момент её обрабатывает не больше одного воркера. Когда в очередях
+# набирается UPDATE_QUEUE_LIMIT апдейтов, submit() ждёт освобождения места.
+class ChatOrderedDispatcher:
+    def __init__(self, process, workers=UPDATE_WORKERS, queue_limit=UPDATE_QUEUE_LIMIT):
+        self._process = process
+        self._worker_count = workers
+        self._queue_limit = queue_limit
+        self._space = asyncio.Semaphore(queue_limit)
+        self._chats = {}  # key → deque апдейтов; ключ есть, пока у чата есть работа
+        self._ready = asyncio.Queue()  # чаты с работой, которые сейчас никто не обрабатывает
+        self._depth = 0
+        self._busy = 0
+        self._busy_seconds = 0.0  # завершённые обработки
+        self._running = {}  # чат → monotonic начала текущей обработки (чат обрабатывает один воркер)
+        self._processed = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._workers = []
+
+    def start(self):
+        if self._workers:
+            return
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self._worker_count)]
+
+    async def stop(self, timeout=UPDATE_DRAIN_TIMEOUT):
+        # Дорабатываем всё, что уже принято, и только потом гасим воркеры
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Dispatcher stopped with %d unprocessed updates", self._depth)
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def submit(self, key, update):
+        if self._space.locked():
+            logger.warning("Update queue is full (%d), applying backpressure", self._depth)
+        await self._space.acquire()
+        self._depth += 1
+        self._idle.clear()
+        queue = self._chats.get(key)
+        if queue is None:
+            self._chats[key] = deque([update])
+            self._ready.put_nowait(key)
+        else:
+            queue.append(update)
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            "queue_depth": self._depth,
+            "active_chats": len(self._chats),
+            "workers": self._worker_count,
+            "busy_workers": self._busy,
+            "processed": self._processed,
+            # Растёт и во время долгих обработок; загрузка — rate() по нему / workers
+            "busy_seconds": self._busy_seconds + sum(now - started for started in self._running.values()),
+        }
+
+    async def _worker(self):
+        while True:
+            key = await self._ready.get()
+            queue = self._chats[key]
+            update = queue.popleft()
+            self._busy += 1
+            started = self._running[key] = time.monotonic()
+            trace_id_var.set(new_trace_id())
+            try:
+                await self._process(update)
+            except Exception:
+                logger.exception("Processing update failed")
+            finally:
+                self._busy -= 1
+                del self._running[key]
+                self._busy_seconds += time.monotonic() - started
+                self._processed += 1
+                self._depth -= 1
+                self._space.release()
+                if queue:
+                    self._ready.put_nowait(key)
+                else:
+                    del self._chats[key]
+                if not self._depth:
+                    self._idle.set()
+
+
+# Application, который отдаёт апдейты в ChatOrderedDispatcher вместо
+# последовательной обработки по одному
+class LifyApplication(Application):
+    def __init__(self, deduplicate=True, **kwargs):
+        super().__init__(**kwargs)
+        self.deduplicate = deduplicate
+        self.dispatcher = ChatOrderedDispatcher(super().process_update)
+
+    async def process_update(self, update):
+        if self.deduplicate and not await update_dedup.first_seen(update):
+            return
+        await self.dispatcher.submit(update_ordering_key(update), update)
+
+    async def start(self):
+        self.dispatcher.start()
+        await super().start()
+        attach_metrics_route(self)
+
+    async def stop(self):
+        await super().stop()
+        # Telegram может быть недоступен — обработчики не должны ждать
+        # повторов отправки, иначе остановка не завершится
+        outbox.begin_stop()
+        await self.dispatcher.stop()
+        # Досылаем очередь, пока HTTP-клиент бота ещё не закрыт в shutdown()
+        await poll_scheduler.stop()
+        await outbox.stop()
+
+
+# /metrics рядом с вебхуком. PTB 20.0 не даёт добавить свои маршруты в
+# сервер вебхука, поэтому обработчик дописывается в его tornado-приложение.
+def attach_metrics_route(application):
+    httpd = getattr(application.updater, "_httpd", None)
+    if not METRICS_PATH or httpd is None:
+        return
+    httpd._http_server.request_callback.add_handlers(r".*", [(METRICS_PATH, MetricsHandler)])
+
+
+# Ключ для склейки повторов: пользователь + текст без регистра и лишних пробелов
+def coalesce_key(user_id, text):
+    return user_id, " ".join(text.casefold().split())
+
+
+# Кэш ответа на последний вопрос каждого пользователя. Отдаём его только
+# на повтор именно этого вопроса: как только пользователь пишет что-то новое,
+# прежний ответ забывается — то же «да» на следующее подтверждение уже
+# другой вопрос. Ограничен по времени жизни и по числу пользователей.
+class AnswerCache:
+    def __init__(self, ttl=ANSWER_CACHE_TTL, size=ANSWER_CACHE_SIZE):
+        self._ttl = ttl
+        self._size = size
+        self._entries = OrderedDict()  # user_id → (key, expires_at, text, parse_mode)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.get(key[0])
+        if entry is None or entry[0] != key or entry[2] is None:
+            return None
+        _, expires_at, text, parse_mode = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key[0]]
+            return None
+        return text, parse_mode
+
+    def ask(self, key):
+        """Новый вопрос ушёл в бэкенд — ответ на предыдущий больше не отдаём."""
+        if self._ttl <= 0:
+            return
+        self._entries[key[0]] = (key, None, None, None)
+        self._entries.move_to_end(key[0])
+        while len(self._entries) > self._size:
+            self._entries.popitem(last=False)
+
+    def put(self, key, text, parse_mode):
+        entry = self._entries.get(key[0])
+        if entry is None or entry[0] != key:
+            return  # пользователь уже спросил другое
+        self._entries[key[0]] = (key, time.monotonic() + self._ttl, text, parse_mode)
+
+
+answer_cache = AnswerCache()
+inflight_questions = {}  # coalesce_key → PendingPoll, пока ответ не доставлен
+
+
+# Ответ в чат апдейта через общую исходящую очередь
+async def reply(update, text, priority=PRIORITY_STATUS, **kwargs):
+    return await outbox.send_message(update.effective_chat.id, text, priority, **kwargs)
 
 # Стартовое сообщение
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(
+    await reply(
+        update,
         "👋 Привет! Я — Telegram-чат для твоего приложения Lify AI.\n\n"
         "Чтобы связать аккаунт, пришли мне свой telegram токен, который находится в твоем профиле в приложении.\n\n"
         "💡 Просто скопируй и вставь его — и сможешь писать сообщения."
@@ -35,26 +1350,48 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # Обработка сообщений
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    started = time.monotonic()
+    try:
+        await _handle_message(update, context)
+    finally:
+        STAGE_SECONDS.observe(time.monotonic() - started, "handle_message")
+
+async def _handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     text = update.message.text.strip()
 
-    if user_id not in user_tokens:
+    jwt_token = token_store.get(user_id)
+    if jwt_token is None:
+        jwt_token = await token_store.load(user_id)
+
+    if jwt_token is None:
         if len(text.split(".")) == 3:
-            user_tokens[user_id] = text
-            await update.message.reply_text("✅ Токен сохранён! Теперь можешь писать сообщения.")
+            exp = jwt_expiry(text)
+            if exp is not None and exp <= time.time():
+                await reply(update, "⌛ Этот токен уже истёк. Возьми новый в приложении.")
+                return
+            token_store.put(user_id, text)
+            await reply(update, "✅ Токен сохранён! Теперь можешь писать сообщения.")
         else:
-            await update.message.reply_text(
+            await reply(
+                update,
                 "🔑 Пришли мне свой telegram токен (JWT), который ты получил в приложении.\n\n"
                 "💡 Просто вставь его сюда — без слова `Bearer`.",
                 parse_mode="Markdown"
             )
         return
 
-    jwt_token = user_tokens[user_id]
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {jwt_token}"
-    }
+    key = coalesce_key(user_id, text)
+    cached = answer_cache.get(key)
+    if cached is not None:
+        COALESCED.inc("cache")
+        await send_answer(update.effective_chat.id, None, *cached)
+        return
+    if key in inflight_questions:
+        # Тот же вопрос ещё обрабатывается — ответ придёт в его сообщение
+        COALESCED.inc("inflight")
+        await reply(update, "🕐 Этот вопрос уже обрабатывается, ответ скоро придёт.")
+        return
 
     user_id_str = f"tg:{str(user_id)}"  # строго строкой
     payload = {
@@ -65,68 +1402,145 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     }
 
     try:
-        post_response = requests.post(f"{API_BASE_URL}/Chat", headers=headers, json=payload)
+        answer_cache.ask(key)
+        post_response = await lify_api.post_chat(jwt_token, payload)
+        if post_response.status_code == 401:
+            token_store.delete(user_id)
+            await reply(update, "🔑 Токен больше не действует. Пришли новый из приложения.")
+            return
         if post_response.status_code != 200:
-            await update.message.reply_text(f"❌ Ошибка: {post_response.text}")
+            await reply(update, f"❌ Ошибка: {post_response.text}", PRIORITY_ERROR)
             return
 
         chat_msg = post_response.json()
         message_id = chat_msg["id"]
 
-        await update.message.reply_text("🕐 Обрабатываю запрос...")
+        placeholder = await reply(update, "🕐 Обрабатываю запрос...")
 
-        # Запускаем фоновую async-задачу
-        context.application.create_task(
-            poll_for_response(user_id, message_id, context.application, jwt_token)
+        # Передаём сообщение общему планировщику опроса
+        pending = PendingPoll(
+            user_id=user_id,
+            chat_id=update.effective_chat.id,
+            message_id=message_id,
+            jwt_token=jwt_token,
+            placeholder_id=placeholder.message_id,
+            coalesce_key=key,
+            trace_id=trace_id_var.get()
         )
+        inflight_questions[key] = pending
+        poll_scheduler.add(pending)
 
     except Exception as e:
-        await update.message.reply_text(f"❌ Ошибка: {str(e)}")
+        logger.warning("POST /Chat failed for %s: %s", user_id, e)
+        await reply(update, f"❌ Ошибка: {str(e)}", PRIORITY_ERROR)
 
-# Ожидание ответа
-async def poll_for_response(user_id, message_id, application, jwt_token):
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {jwt_token}"
-    }
+# Текст ответа из опрошенного сообщения → (text, parse_mode)
+def render_response(data):
+    ai_type = data.get("type")
+    msg_text = data.get("message", "")
 
-    while True:
+    if ai_type == 2:
         try:
-            resp = requests.get(f"{API_BASE_URL}/Chat/{message_id}", headers=headers)
-            if resp.status_code != 200:
-                await application.bot.send_message(chat_id=user_id, text=f"❌ Ошибка: {resp.text}")
-                return
+            parsed = json.loads(msg_text)
+            formatted = format_confirm_request(parsed)
+            return f"🤖 Подтверждение:\n\n{formatted}", "Markdown"
+        except Exception:
+            return f"🤖 ConfirmRequest, но не удалось разобрать JSON:\n{msg_text}", None
+    return f"🤖 Ответ:\n{msg_text}", None
 
-            data = resp.json()
-            if data.get("type") != 1:
-                break
-            await asyncio.sleep(POLLING_INTERVAL)
-        except Exception as e:
-            await application.bot.send_message(chat_id=user_id, text=f"❌ Ошибка: {str(e)}")
-            return
+# Разбивка длинного текста на части по лимиту Telegram, по возможности по строкам
+def split_message(text, limit=MessageLimit.MAX_TEXT_LENGTH):
+    chunks = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = limit
+        chunks.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    chunks.append(text)
+    return chunks
 
-    try:
-        final_resp = requests.get(f"{API_BASE_URL}/Chat/Count/1/0", headers=headers)
-        if final_resp.status_code != 200:
-            await application.bot.send_message(chat_id=user_id, text=f"❌ Ошибка: {final_resp.text}")
-            return
+# Время последней правки (chat_id, message_id) — чтобы не упираться в лимиты Telegram
+_last_edit = {}
 
-        latest = final_resp.json()[0]
-        ai_type = latest.get("type")
-        msg_text = latest.get("message", "")
+async def edit_throttled(chat_id, message_id, text, parse_mode=None, final=False, priority=PRIORITY_STATUS):
+    key = (chat_id, message_id)
+    wait = _last_edit.get(key, 0) + EDIT_MIN_INTERVAL - time.monotonic()
+    if wait > 0:
+        if not final:
+            return False  # промежуточную правку можно пропустить
+        await asyncio.sleep(wait)
 
-        if ai_type == 2:
-            try:
-                parsed = json.loads(msg_text)
-                formatted = format_confirm_request(parsed)
-                await application.bot.send_message(chat_id=user_id, text=f"🤖 Подтверждение:\n\n{formatted}", parse_mode="Markdown")
-            except Exception:
-                await application.bot.send_message(chat_id=user_id, text=f"🤖 ConfirmRequest, но не удалось разобрать JSON:\n{msg_text}")
+    _last_edit[key] = time.monotonic()
+    try:
+        await outbox.edit_message_text(chat_id, message_id, text, priority, parse_mode=parse_mode)
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            raise
+    finally:
+        if final:
+            _last_edit.pop(key, None)
+    return True
+
+# Отправка одной части с откатом на обычный текст, если Markdown не разобрался
+async def _send_chunk(chat_id, placeholder_id, text, parse_mode, priority):
+    try:
+        if placeholder_id:
+            await edit_throttled(chat_id, placeholder_id, text, parse_mode, final=True, priority=priority)
         else:
-            await application.bot.send_message(chat_id=user_id, text=f"🤖 Ответ:\n{msg_text}")
+            await outbox.send_message(chat_id, text, priority, parse_mode=parse_mode)
+    except BadRequest as e:
+        if parse_mode is None or "parse" not in str(e).lower():
+            raise
+        await _send_chunk(chat_id, placeholder_id, text, None, priority)
 
+async def send_answer(chat_id, placeholder_id, text, parse_mode=None, priority=PRIORITY_ANSWER):
+    chunks = split_message(text)
+    if DELIVERY_MODE == "edit" and placeholder_id:
+        try:
+            await _send_chunk(chat_id, placeholder_id, chunks[0], parse_mode, priority)
+            chunks = chunks[1:]
+        except BadRequest as e:
+            # Сообщение-заглушку удалили или его уже нельзя править — шлём новое
+            logger.warning("Editing placeholder %s failed: %s", placeholder_id, e)
+    for chunk in chunks:
+        await _send_chunk(chat_id, None, chunk, parse_mode, priority)
+
+# Доставка ответа, когда сообщение обработано
+async def deliver_response(application, pending, data):
+    started = time.monotonic()
+    text, parse_mode = render_response(data)
+    STAGE_SECONDS.observe(time.monotonic() - started, "render")
+    if pending.coalesce_key is not None and data.get("type") != 2:
+        # На ConfirmRequest пользователь отвечает, а не переспрашивает — не кэшируем
+        answer_cache.put(pending.coalesce_key, text, parse_mode)
+    try:
+        await send_answer(pending.chat_id, pending.placeholder_id, text, parse_mode)
     except Exception as e:
-        await application.bot.send_message(chat_id=user_id, text=f"❌ Ошибка: {str(e)}")
+        await outbox.send_message(pending.chat_id, f"❌ Ошибка: {str(e)}", PRIORITY_ERROR)
+
+async def deliver_partial(application, pending, partial):
+    if DELIVERY_MODE != "edit" or not pending.placeholder_id:
+        return
+    text = f"🤖 Ответ:\n{partial}"[:MessageLimit.MAX_TEXT_LENGTH]
+    await edit_throttled(pending.chat_id, pending.placeholder_id, text)
+
+async def deliver_error(application, pending, text):
+    await send_answer(pending.chat_id, pending.placeholder_id, text, priority=PRIORITY_ERROR)
+
+# Опрос завершён как угодно — повторы вопроса снова идут в бэкенд
+def release_question(pending):
+    if pending.coalesce_key is not None and inflight_questions.get(pending.coalesce_key) is pending:
+        del inflight_questions[pending.coalesce_key]
+
+poll_scheduler = PollScheduler(
+    lify_api,
+    on_ready=deliver_response,
+    on_error=deliver_error,
+    on_partial=deliver_partial,
+    on_finish=release_question,
+    journal=poll_journal
+)
 
 # ✅ Форматирование ConfirmRequest
 def format_confirm_request(data):
@@ -153,6 +1567,196 @@ def format_confirm_request(data):
 
     return "\n".join(result)
 
+# Опросы из журнала, которые бросил другой процесс или предыдущий запуск
+def resume_polls(rows):
+    now, wall_now = time.monotonic(), time.time()
+    for message_id, user_id, chat_id, placeholder_id, jwt_token, deadline_at in rows:
+        if message_id in poll_scheduler:
+            continue
+        poll_scheduler.add(PendingPoll(
+            user_id=user_id,
+            chat_id=chat_id,
+            message_id=message_id,
+            jwt_token=jwt_token,
+            placeholder_id=placeholder_id,
+            deadline=now + max(deadline_at - wall_now, 0.001)
+        ))
+
+
+# Метрики состояния: очереди, воркеры, ожидающие ответы
+_metrics_application = None
+_loop_lag_task = None
+
+
+def _dispatcher_stat(key):
+    if not isinstance(_metrics_application, LifyApplication):
+        return 0
+    return _metrics_application.dispatcher.stats()[key]
+
+
+Gauge("lify_inflight_polls", "Сообщения, ответ на которые ещё опрашивается", lambda: len(poll_scheduler))
+Gauge("lify_outbound_queue_depth", "Сообщения в исходящей очереди Telegram", lambda: len(outbox))
+Gauge("lify_token_cache_size", "Токены в кэше в памяти", lambda: len(token_store))
+Gauge("lify_update_queue_depth", "Апдейты в очередях диспетчера", lambda: _dispatcher_stat("queue_depth"))
+Gauge("lify_update_workers_busy", "Занятые воркеры диспетчера", lambda: _dispatcher_stat("busy_workers"))
+Gauge("lify_update_workers", "Размер пула воркеров диспетчера", lambda: _dispatcher_stat("workers"))
+CounterFunc(
+    "lify_update_worker_busy_seconds_total", "Суммарное время работы воркеров диспетчера, включая текущие обработки",
+    lambda: _dispatcher_stat("busy_seconds")
+)
+
+
+# Жизненный цикл общих ресурсов
+async def post_init(application):
+    global _metrics_application, _loop_lag_task
+    _metrics_application = application
+    _loop_lag_task = asyncio.create_task(sample_event_loop_lag())
+    await token_store.start()
+    await poll_journal.start()
+    await lify_api.start()
+    outbox.start(application.bot)
+    poll_scheduler.start(application)
+    poll_journal.run(resume_polls)
+
+
+async def post_shutdown(application):
+    # poll_scheduler и outbox уже остановлены в LifyApplication.stop()
+    await poll_journal.close()
+    await lify_api.close()
+    await token_store.close()
+    if _loop_lag_task is not None:
+        _loop_lag_task.cancel()
+
+
+def build_application(updater=True, deduplicate=True, base_url=None):
+    builder = (
+        ApplicationBuilder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .application_class(LifyApplication, {"deduplicate": deduplicate})
+        # Ограниченная очередь: при заполнении ждёт уже сам запрос вебхука
+        .update_queue(asyncio.Queue(UPDATE_QUEUE_LIMIT))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if base_url:
+        builder = builder.base_url(base_url)  # например, тестовый Bot API в bench.py
+    if not updater:
+        builder = builder.updater(None)
+    app = builder.build()
+    app.add_handler(CommandHandler("start", start))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    return app
+
+
+# Шардированный режим: воркер получает апдейты своих чатов от роутера
+def run_worker(index, updates, workers):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # останавливает роутер через очередь
+    setup_logging(prefix=f"worker-{index} ")
+    asyncio.run(_worker_main(index, updates, workers))
+
+
+async def _worker_main(index, updates, workers):
+    # Лимиты SEND_GLOBAL_RATE и POLL_MAX_RPS общие на весь бот — делим между воркерами
+    outbox.set_global_rate(SEND_GLOBAL_RATE / workers)
+    poll_scheduler.set_max_rps(POLL_MAX_RPS / workers)
+    app = build_application(updater=False, deduplicate=False)
+    if METRICS_WORKER_PORT and METRICS_PATH:
+        # У воркеров нет сервера вебхука — метрики на своём порту
+        HTTPServer(tornado.web.Application([(METRICS_PATH, MetricsHandler)])).listen(METRICS_WORKER_PORT + index)
+    stop = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+
+    await app.initialize()
+    await post_init(app)
+    await app.start()
+    try:
+        while not stop.is_set():
+            try:
+                payload = await asyncio.to_thread(updates.get, timeout=1)
+            except Empty:
+                continue
+            if payload is None:
+                break
+            await app.update_queue.put(Update.de_json(payload, app.bot))
+    finally:
+        await app.stop()
+        await app.shutdown()
+        await post_shutdown(app)
+
+
+# Роутер шардов: принимает вебхук, отбрасывает дубли по update_id и
+# отправляет апдейт воркеру, которому принадлежит чат
+class ShardRouter:
+    def __init__(self, workers=WEBHOOK_WORKERS):
+        self._ctx = multiprocessing.get_context("spawn")
+        self._queues = [self._ctx.Queue() for _ in range(workers)]
+        self._processes = [None] * workers
+        self._task = None
+
+    def route(self, update):
+        key = update_ordering_key(update)[1]
+        return self._queues[hash(key) % len(self._queues)]
+
+    def _spawn(self, index):
+        process = self._ctx.Process(target=run_worker, args=(index, self._queues[index], len(self._queues)),
+                                    name=f"lify-worker-{index}")
+        process.start()
+        self._processes[index] = process
+
+    async def start(self, application):
+        await poll_journal.start()
+        for index in range(len(self._processes)):
+            self._spawn(index)
+        self._task = asyncio.create_task(self._supervise())
+
+    async def stop(self, application):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        for queue in self._queues:
+            queue.put(None)
+        for process in self._processes:
+            await asyncio.to_thread(process.join, SEND_DRAIN_TIMEOUT + 20)
+            if process.is_alive():
+                process.terminate()
+        await poll_journal.close()
+
+    async def _supervise(self):
+        while True:
+            await asyncio.sleep(WORKER_RESTART_INTERVAL)
+            for index, process in enumerate(self._processes):
+                if not process.is_alive():
+                    logger.warning("Worker %d exited with %s, restarting", index, process.exitcode)
+                    self._spawn(index)
+
+
+class RouterApplication(Application):
+    def __init__(self, router, **kwargs):
+        super().__init__(**kwargs)
+        self.router = router
+
+    async def process_update(self, update):
+        if not isinstance(update, Update) or not await update_dedup.first_seen(update):
+            return
+        self.router.route(update).put(update.to_dict())
+
+    async def start(self):
+        await super().start()
+        attach_metrics_route(self)
+
+
+def build_router_application():
+    router = ShardRouter()
+    return (
+        ApplicationBuilder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .application_class(RouterApplication, {"router": router})
+        .post_init(router.start)
+        .post_shutdown(router.stop)
+        .build()
+    )
+
+
 # Основной запуск
 def main():
     if not TELEGRAM_BOT_TOKEN or not WEBHOOK_HOST:
@@ -162,9 +1766,13 @@ def main():
     path = WEBHOOK_PATH if WEBHOOK_PATH.startswith("/") else f"/{WEBHOOK_PATH}"
     webhook_url = f"{WEBHOOK_HOST.rstrip('/')}{path}"
 
-    app = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    setup_logging()
+
+    if WEBHOOK_WORKERS > 1:
+        app = build_router_application()
+        print(f"🧩 Шардированный режим: {WEBHOOK_WORKERS} воркеров")
+    else:
+        app = build_application()
 
     print(f"📡 Запуск webhook: {webhook_url}")
     app.run_webhook(